@@ -1,8 +1,17 @@
-from fastapi import FastAPI, BackgroundTasks, APIRouter
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi import FastAPI, APIRouter
+from fastapi.responses import Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse
 from fastapi.responses import PlainTextResponse
 from typing import Optional
 from pathlib import Path
+from functools import lru_cache
+import asyncio
+import csv
+import hashlib
+import io
+import threading
+import time
 import uvicorn
 import secure_rds as secure
 import rds_functions as rds
@@ -21,6 +30,9 @@ app = FastAPI(
     docs_url=os.environ.get("BASE_URL", "") + "/docs",
     openapi_url=os.environ.get("BASE_URL", "") + "/openapi.json",
 )
+# Compress larger responses on the wire; the table/query endpoints return
+# repetitive HTML and CSV that compresses very well
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 router = None
 
 if "BASE_URL" in os.environ:
@@ -29,19 +41,12 @@ else:
     router = APIRouter()
 
 
-# Function to removed the created CSV/HTML file
-def remove_file(path):
-    try:
-        os.unlink(path)
-        logging.info("Successfully removed file")
-    except Exception as e:
-        logging.error("Failed to delete %s." % path)
-        print(e)
-
-
 #
 # Loads the key into key.conf
+#    Cached: the key is fixed for the life of the process, so the env
+#    lookup / key file read happens once instead of on every Slack call
 #
+@lru_cache(maxsize=1)
 def load_key():
     if os.environ.get("MAJOR_KEY", ""):
         return os.environ.get("MAJOR_KEY", "")
@@ -51,51 +56,103 @@ def load_key():
 
 
 # Telling the logger where to log the information
+# ( basicConfig only takes effect once per process, so the second call that
+#   used to point at logs/errors.txt was always ignored )
 logging.basicConfig(
     filename="logs/logs.txt", level=logging.DEBUG, format="%(asctime)s %(message)s"
 )
-logging.basicConfig(
-    filename="logs/errors.txt", level=logging.ERROR, format="%(asctime)s %(message)s"
+logger = logging.getLogger(__name__)
+
+
+# Health checks poll the root path constantly and drown the access log.
+# A filter attached once to uvicorn's access logger drops just those
+# lines, so ordinary requests pay no extra per-request work
+_ROOT_PATHS = frozenset(
+    {os.environ.get("BASE_URL", "") + "/", os.environ.get("BASE_URL", "") or "/"}
 )
 
 
+class _RootAccessFilter(logging.Filter):
+    # uvicorn access records carry (client, method, path, ...) in args
+    def filter(self, record):
+        args = record.args
+        return not (
+            isinstance(args, tuple) and len(args) >= 3 and args[2] in _ROOT_PATHS
+        )
+
+
+logging.getLogger("uvicorn.access").addFilter(_RootAccessFilter())
+
+
+# Warm the database connection and the table metadata cache once per
+# process so the first real request does not pay the cold-start cost;
+# building the OpenAPI schema here also makes the first /docs hit fast
+@app.on_event("startup")
+def warmup():
+    app.openapi()
+    try:
+        get_dataportal_html()
+    except Exception as e:
+        logger.error("Could not preload the data portal page")
+        print(e)
+    try:
+        conn = secure.connect_public()
+        cur = conn.cursor()
+        rds.displayTables(cur)
+        logger.info("Warmed database connection and table cache")
+    except Exception as e:
+        logger.error("Warmup failed, first request will connect instead")
+        print(e)
+
+
+# The root greeting never changes, so the JSON body is encoded once at
+# import; health checks hitting this path then cost no per-request
+# serialization ( or log write, see the access-log filter above )
+_ROOT_BODY = json.dumps("Welcome to the public GBADs database tables!")
+
+
 # Used to access the data portal screen
 @router.get("/", include_in_schema=False)
 @router.head("/", include_in_schema=False)
 def main():
-    logging.info("Main endpoint accessed (/)")
-    return "Welcome to the public GBADs database tables!"
+    return Response(_ROOT_BODY, media_type="application/json")
+
+
+# The data portal page is static, so read it from disk once per process
+# instead of on every request
+@lru_cache(maxsize=1)
+def get_dataportal_html():
+    return Path("dataPortalDocumentation.html").read_text()
 
 
 # Used to access the data portal screen
 @router.get("/dataportal/", tags=["Knowledge Engine"])
 def home():
-    logging.info("Home page accessed")
-    html_string = Path("dataPortalDocumentation.html").read_text()
-    return HTMLResponse(html_string)
+    logger.info("Home page accessed")
+    return HTMLResponse(get_dataportal_html())
 
 
 # Used to access the list of all tables
 @router.get("/GBADsTables/{public}", tags=["Knowledge Engine"])
 async def get_public_tables(public: str, format: Optional[str] = "html"):
-    logging.info("GBADsTables/{public} called")
+    logger.info("GBADsTables/{public} called")
 
     # Establish a connection to the aws server
     try:
-        conn = secure.connect_public()
+        conn = await asyncio.to_thread(secure.connect_public)
         cur = conn.cursor()
-        logging.info("Connected to GBAD database")
+        logger.info("Connected to GBAD database")
     except Exception as e:
-        logging.error("Error connecting to GBAD database")
+        logger.error("Error connecting to GBAD database")
         htmlMsg = rds.generateHTMLErrorMessage("Error connecting to Database: " + str(e))
         return HTMLResponse(htmlMsg)
 
     # Get the list of tables from the database
-    logging.info("Fetching tables")
+    logger.info("Fetching tables")
     try:
-        tables = rds.displayTables(cur)
+        tables = await asyncio.to_thread(rds.displayTables, cur)
     except Exception as e:
-        logging.error("Error fetching tables")
+        logger.error("Error fetching tables")
         htmlMsg = rds.generateHTMLErrorMessage("Error fetching tables: " + str(e))
         return HTMLResponse(htmlMsg)
 
@@ -107,25 +164,25 @@ async def get_public_tables(public: str, format: Optional[str] = "html"):
     tableCount = 0
 
     # List each table from the query in the html string and return string
-    logging.info("Formatting tables into HTML and the return string")
+    logger.info("Formatting tables into HTML and the return string")
     for table in tables:
         tableCount = tableCount + 1
         if tableCount < fieldCount:
-            htmlstring = htmlstring + "<li> " + table[1]
+            htmlstring = htmlstring + "<li> " + table[0]
             if tableCount == 1:
-                retstring = table[1]
+                retstring = table[0]
             else:
-                retstring = retstring + "," + table[1]
+                retstring = retstring + "," + table[0]
         else:
-            htmlstring = htmlstring + "<li> " + table[1] + "</ul></body></html>"
-            retstring = retstring + "," + table[1]
+            htmlstring = htmlstring + "<li> " + table[0] + "</ul></body></html>"
+            retstring = retstring + "," + table[0]
 
     # Return the text or html string to the user
     if format == "text":
-        logging.info("Returning tables as text")
+        logger.info("Returning tables as text")
         return PlainTextResponse(retstring)
     else:
-        logging.info("Returning tables as HTML")
+        logger.info("Returning tables as HTML")
         return HTMLResponse(htmlstring)
 
 
@@ -133,24 +190,24 @@ async def get_public_tables(public: str, format: Optional[str] = "html"):
 async def get_public_table_fields(
     public: str, table_name: str, format: Optional[str] = "html"
 ):
-    logging.info("GBADs Public Query called")
+    logger.info("GBADs Public Query called")
 
     # Establish connection to AWS
     try:
-        conn = secure.connect_public()
+        conn = await asyncio.to_thread(secure.connect_public)
         cur = conn.cursor()
-        logging.info("Connected to GBAD database")
+        logger.info("Connected to GBAD database")
     except Exception as e:
-        logging.error("Error connecting to GBAD database")
+        logger.error("Error connecting to GBAD database")
         htmlMsg = rds.generateHTMLErrorMessage("Error connecting to Database: " + str(e))
         return HTMLResponse(htmlMsg)
 
     # Get table info
-    logging.info("Fetching fields")
+    logger.info("Fetching fields")
     try:
-        fields = rds.displayTabInfo(cur, table_name)
+        fields = await asyncio.to_thread(rds.displayTabInfo, cur, table_name)
     except Exception as e:
-        logging.error("Error fetching fields")
+        logger.error("Error fetching fields")
         htmlMsg = rds.generateHTMLErrorMessage("Error fetching fields: " + str(e))
         return HTMLResponse(htmlMsg)
 
@@ -160,7 +217,7 @@ async def get_public_table_fields(
     retstring = ""
     tableCount = 0
 
-    logging.info("Formatting fields into HTML and the return string")
+    logger.info("Formatting fields into HTML and the return string")
     for field in fields:
         tableCount = tableCount + 1
         if tableCount < fieldCount:
@@ -178,10 +235,10 @@ async def get_public_table_fields(
             retstring = retstring + field[0]
 
     if format == "html":
-        logging.info("Returning fields as HTML")
+        logger.info("Returning fields as HTML")
         return HTMLResponse(htmlstring)
     else:
-        logging.info("Returning fields as text")
+        logger.info("Returning fields as text")
         return PlainTextResponse(retstring)
 
 
@@ -195,37 +252,20 @@ async def get_db_query(
     format: Optional[str] = "html",
     count: Optional[str] = "no",
     pivot: Optional[str] = "",
-    background_tasks: BackgroundTasks = None,
 ):
-    logging.info("GBADsPublicQuery called")
+    logger.info("GBADsPublicQuery called")
 
     # Establish connection to AWS
     try:
-        conn = secure.connect_public()
+        conn = await asyncio.to_thread(secure.connect_public)
         cur = conn.cursor()
-        logging.info("Connected to GBAD database")
+        logger.info("Connected to GBAD database")
     except Exception as e:
-        logging.error("Error connecting to GBAD database")
+        logger.error("Error connecting to GBAD database")
         htmlMsg = rds.generateHTMLErrorMessage("Error connecting to Database: " + str(e))
         return HTMLResponse(htmlMsg)
 
-    # Get all fields if fields == *
-    if fields == "*":
-        try:
-            newfields = rds.generateFieldNames(cur, table_name)
-        except Exception as e:
-            logging.error("Error fetching fields")
-            htmlMsg = rds.generateHTMLErrorMessage("Error fetching fields: " + str(e))
-            return HTMLResponse(htmlMsg)
-
-        # Format the fields into a string
-        fields = ""
-        for i in range(len(newfields)):
-            fields = fields + newfields[i]
-            if i < len(newfields) - 1:
-                fields = fields + ","
-
-    logging.info("Formatting the query")
+    logger.info("Formatting the query")
     joinitems = []
     if join != "":
         joinitems = join.split(",")
@@ -237,37 +277,46 @@ async def get_db_query(
     else:
         joinstring = ""
 
-    logging.info("Setting and running the query on the database")
+    logger.info("Setting and running the query on the database")
     if count == "no":
         try:
-            returnedQuery = rds.query(cur, table_name, fields, query, joinstring, order)
+            returnedQuery = await asyncio.to_thread(
+                rds.queryStream, cur, table_name, fields, query, joinstring, order
+            )
         except Exception as e:
-            logging.error("Error running the query")
+            logger.error("Error running the query")
             htmlMsg = rds.generateHTMLErrorMessage(
                 "Error in the given query. Please check the syntax and try again. " + str(e)
             )
             return HTMLResponse(htmlMsg)
-
-        querystr = rds.setQuery(table_name, fields, query, joinstring)
     else:
         try:
-            returnedQuery = rds.countQuery(
-                cur, table_name, fields, query, joinstring, order
+            returnedQuery = await asyncio.to_thread(
+                rds.countQuery, cur, table_name, fields, query, joinstring, order
             )
         except Exception as e:
-            logging.error("Error running the query")
+            logger.error("Error running the query")
             htmlMsg = rds.generateHTMLErrorMessage(
                 "Error in the given query. Please check the syntax and try again. " + str(e)
             )
             return HTMLResponse(htmlMsg)
 
+    # A "*" select no longer triggers a separate introspection query: the
+    # database expands the star itself and the driver reports the column
+    # names it returned in cursor.description ( which also covers joins )
+    if fields == "*":
+        fields = ",".join(desc[0] for desc in cur.description)
+
+    if count == "no":
+        querystr = rds.setQuery(table_name, fields, query, joinstring)
+    else:
         querystr = rds.setCountQuery(table_name, fields, query, joinstring)
 
     # debugging
     # print ( query )
 
     # Format the query into the html and return string
-    logging.info("Formatting the results into a file and reutrn string")
+    logger.info("Formatting the results into a file and reutrn string")
     htmlstring = "<head> <style> table { font-family: arial, sans-serif; border-collapse: collapse; width: 80%; }"
     htmlstring = (
         htmlstring
@@ -284,33 +333,52 @@ async def get_db_query(
         htmlstring = htmlstring + "<td><b>" + col + "</b></td>"
     htmlstring = htmlstring + "</tr>"
     file_name = table_name + ".csv"
-    f = open(file_name, "w")
+    f = io.StringIO()
     print(fields, file=f)
+    # csv.writer runs in C; building the rows with it is much faster than
+    # per-value string concatenation on large exports
+    writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator="\n")
 
     # Format the rows of the table
     for field in returnedQuery:
-        x = 0
-        htmlstring = htmlstring + "<tr>"
-        while x < len(field) - 1:
-            print('"' + str(field[x]) + '"', end=",", file=f)
-            fstring = str(field[x])
-            htmlstring = htmlstring + "<td>" + fstring.rstrip() + "</td>"
-            x = x + 1
-        fstring = str(field[x])
-        htmlstring = htmlstring + "<td>" + fstring.rstrip() + "</td></tr>"
-        print('"' + str(field[x]) + '"', file=f)
+        writer.writerow([str(x) for x in field])
+        htmlstring = (
+            htmlstring
+            + "<tr>"
+            + "".join("<td>" + str(x).rstrip() + "</td>" for x in field)
+            + "</tr>"
+        )
     htmlstring = htmlstring + "</table></body></html>"
-    f.close()
 
-    # Return the html or text string to the user
+    # Return the html or csv string to the user ( the CSV is built in
+    # memory, so there is no temp file to write and clean up )
     if format == "html":
-        logging.info("Returning results as HTML")
-        background_tasks.add_task(remove_file, file_name)
+        logger.info("Returning results as HTML")
         return HTMLResponse(htmlstring)
     else:
-        logging.info("Returning results as CSV")
-        background_tasks.add_task(remove_file, file_name)
-        return FileResponse(file_name, filename=file_name)
+        logger.info("Returning results as CSV")
+        return Response(
+            f.getvalue(),
+            media_type="text/csv",
+            headers={"Content-Disposition": 'attachment; filename="' + file_name + '"'},
+        )
+
+
+# Aggregate species groups expanded per data source, built once at import
+# so each request does a dict lookup instead of rebuilding the OR strings
+SPECIES_GROUPS = {
+    "oie": {
+        "Poultry": "(species='Birds' OR species='Layers' OR species='Broilers' OR species='Turkeys' OR species='Other commercial poultry' OR species='Backyard poultry')",
+        "All Cattle": "(species='Cattle' OR species='Male and female cattle' OR species='Adult beef cattle' OR species='Adult dairy cattle' OR species='Calves')",
+        "All Swine": "(species='Swine' OR species='Adult pigs' OR species='Backyard pigs' OR species='Commercial pigs' OR species='Fattening pigs' OR species='Piglets')",
+        "All Sheep": "(species='Sheep' OR species='Adult sheep' OR species='Lambs')",
+        "All Goats": "(species='Goats' OR species='Adult goats' OR species='Kids')",
+        "All Equids": "(species='Equidae' OR species='Domestic Horses' OR species='Donkeys/ Mules/ Hinnies')",
+    },
+    "faostat": {
+        "Poultry": "(species='Chickens' OR species='Turkeys' OR species='Ducks' OR species='Geese and guinea fowls')",
+    },
+}
 
 
 @router.get("/GBADsLivestockPopulation/{data_source}", tags=["Knowledge Engine"])
@@ -321,21 +389,12 @@ async def get_population(
     iso3: Optional[str] = "*",
     country: Optional[str] = "*",
     species: Optional[str] = "*",
-    background_tasks: BackgroundTasks = None,
 ):
-    logging.info("GBADsLivestockPopulation called")
+    logger.info("GBADsLivestockPopulation called")
 
-    # Establish a connection to AWS
-    try:
-        conn = secure.connect_public()
-        cur = conn.cursor()
-        logging.info("Connected to GBAD database")
-    except Exception as e:
-        logging.error("Error connecting to GBAD database")
-        htmlMsg = rds.generateHTMLErrorMessage("Error connecting to Database: " + str(e))
-        return HTMLResponse(htmlMsg)
-
-    logging.info("Formatting query")
+    # Validate the inputs before connecting: a bad data source, format or
+    # year can be rejected without costing a database round trip
+    logger.info("Formatting query")
     if data_source == "oie":
         table_name = "livestock_national_population_" + data_source
         fields = "country,year,species,population,metadataflags"
@@ -347,43 +406,64 @@ async def get_population(
     else:
         return "Invalid data source, Try faostat or oie instead"
 
+    if format not in ("html", "file"):
+        logger.error("Invalid format")
+        htmlstring = rds.generateHTMLErrorMessage(
+            "Invalid format. Please use html or file."
+        )
+        return HTMLResponse(htmlstring)
+
+    if year != "*" and not year.isdigit():
+        logger.error("Invalid year")
+        htmlstring = rds.generateHTMLErrorMessage(
+            "Invalid year. Please use a number or *."
+        )
+        return HTMLResponse(htmlstring)
+
+    # Establish a connection to AWS
+    try:
+        conn = await asyncio.to_thread(secure.connect_public)
+        cur = conn.cursor()
+        logger.info("Connected to GBAD database")
+    except Exception as e:
+        logger.error("Error connecting to GBAD database")
+        htmlMsg = rds.generateHTMLErrorMessage("Error connecting to Database: " + str(e))
+        return HTMLResponse(htmlMsg)
+
+    # The filter values are passed to psycopg2 as parameters rather than
+    # pasted into the SQL: the server sees the same statement text for
+    # every year/country/species and can reuse the plan, and the values
+    # are quoted safely
     query1 = ""
     query2 = ""
     query3 = ""
+    param1 = None
+    param2 = None
+    param3 = None
     if year != "*":
-        query1 = "year=" + year
+        query1 = "year=%s"
+        param1 = year
 
     if country != "*":
         if data_source == "faostat":
-            query2 = "country='" + country + "'"
+            query2 = "country=%s"
+            param2 = country
         elif data_source == "oie":
-            query2 = "country='" + country + "'"
+            query2 = "country=%s"
+            param2 = country
 
     if iso3 != "*":
         if data_source == "faostat":
-            query2 = "iso3='" + iso3 + "'"
+            query2 = "iso3=%s"
+            param2 = iso3
 
     if species != "*":
-        if data_source == "oie":
-            if species == "Poultry":
-                query3 = "(species='Birds' OR species='Layers' OR species='Broilers' OR species='Turkeys' OR species='Other commercial poultry' OR species='Backyard poultry')"
-            elif species == "All Cattle":
-                query3 = "(species='Cattle' OR species='Male and female cattle' OR species='Adult beef cattle' OR species='Adult dairy cattle' OR species='Calves')"
-            elif species == "All Swine":
-                query3 = "(species='Swine' OR species='Adult pigs' OR species='Backyard pigs' OR species='Commercial pigs' OR species='Fattening pigs' OR species='Piglets')"
-            elif species == "All Sheep":
-                query3 = "(species='Sheep' OR species='Adult sheep' OR species='Lambs')"
-            elif species == "All Goats":
-                query3 = "(species='Goats' OR species='Adult goats' OR species='Kids')"
-            elif species == "All Equids":
-                query3 = "(species='Equidae' OR species='Domestic Horses' OR species='Donkeys/ Mules/ Hinnies')"
-            else:
-                query3 = "species='" + species + "'"
+        groups = SPECIES_GROUPS.get(data_source, {})
+        if species in groups:
+            query3 = groups[species]
         else:
-            if species == "Poultry":
-                query3 = "(species='Chickens' OR species='Turkeys' OR species='Ducks' OR species='Geese and guinea fowls')"
-            else:
-                query3 = "species='" + species + "'"
+            query3 = "species=%s"
+            param3 = species
 
     query = ""
     if query1 != "":
@@ -398,16 +478,22 @@ async def get_population(
             query = query3
         else:
             query = query + " AND " + query3
+    params = [p for p in (param1, param2, param3) if p is not None]
 
     joinstring = ""
-    logging.info("Setting and runnning the query on the database")
+    logger.info("Setting and runnning the query on the database")
     querystr = rds.setQuery(table_name, fields, query, joinstring)
+    if params:
+        # show the query with the values filled in, as the server runs it
+        querystr = cur.mogrify(querystr, params).decode("utf-8")
 
     try:
-        returnedQuery = rds.query(cur, table_name, fields, query, joinstring)
-        logging.info("Query returned")
+        returnedQuery = await asyncio.to_thread(
+            rds.queryStream, cur, table_name, fields, query, joinstring, "", 1000, params
+        )
+        logger.info("Query returned")
     except Exception as e:
-        logging.error("Error running query")
+        logger.error("Error running query")
         htmlstring = rds.generateHTMLErrorMessage(
             "Error in the given query. Please check the syntax and try again. " + str(e)
         )
@@ -434,102 +520,156 @@ async def get_population(
         htmlstring = htmlstring + "<td><b>" + col + "</b></td>"
     htmlstring = htmlstring + "</tr>"
     file_name = table_name + ".csv"
-    f = open(file_name, "w")
+    f = io.StringIO()
     print(fields, file=f)
+    writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator="\n")
     # print("returnedQuery ",returnedQuery)
 
-    logging.info("Adding the returned data to the htmlstring and CSV file")
+    logger.info("Adding the returned data to the htmlstring and CSV file")
     for field in returnedQuery:
-        x = 0
-        htmlstring = htmlstring + "<tr>"
-        while x < len(field) - 1:
-            if str(field[x])[0] != '"':
-                print('"' + str(field[x]) + '"', end=",", file=f)
-            else:
-                print(str(field[x]), end=",", file=f)
-            fstring = str(field[x])
-            htmlstring = htmlstring + "<td>" + fstring.strip('"') + "</td>"
-            x = x + 1
-        fstring = str(field[x])
-        htmlstring = htmlstring + "<td>" + fstring.strip('"') + "</td></tr>"
-        if str(field[x])[0] != '"':
-            print('"' + str(field[x]) + '"', file=f)
-        else:
-            print(str(field[x]), file=f)
+        writer.writerow([str(x).strip('"') for x in field])
+        htmlstring = (
+            htmlstring
+            + "<tr>"
+            + "".join("<td>" + str(x).strip('"') + "</td>" for x in field)
+            + "</tr>"
+        )
     htmlstring = htmlstring + "</table></body></html>"
-    f.close()
 
+    # The CSV is built in memory, so nothing is written to ( or cleaned
+    # up from ) the local disk
     if format == "file":
-        # Remove file after sending it
-        background_tasks.add_task(remove_file, file_name)
-        logging.info("Returning data as a csv")
-        return FileResponse(file_name, filename=file_name)
-
-    elif format == "html":
-        background_tasks.add_task(remove_file, file_name)
-        logging.info("Returning data as HTML")
-        return HTMLResponse(htmlstring)
-    else:
-        logging.error("Invalid format")
-        background_tasks.add_task(remove_file, file_name)
-        htmlstring = rds.generateHTMLErrorMessage(
-            "Invalid format. Please use html or file."
+        logger.info("Returning data as a csv")
+        return Response(
+            f.getvalue(),
+            media_type="text/csv",
+            headers={"Content-Disposition": 'attachment; filename="' + file_name + '"'},
         )
+    else:
+        logger.info("Returning data as HTML")
         return HTMLResponse(htmlstring)
 
 
-@router.post("/slack/approve/{comment_id}", tags=["Internal Slack"])
-async def slack_approve_comment(
-    comment_id: str, authorization_token: str, reviewer: Optional[str] = "none"
-):
-    logging.info("/slack/approve called")
-    #
-    # Information for the task
-    #
-    key_filename = "slackbot_comments_move_approve_key.pub"
-    #
-    # Read in the public key
-    #
-    try:
-        fptr = open(key_filename, "rb")
-        key = fptr.read()
-        fptr.close()
-    except Exception as e:
-        logging.error("Bad information about public key filename")
-        htmlMsg = rds.generateHTMLErrorMessage(
-            "Bad information about public key filename: " + str(e)
-        )
-        return HTMLResponse(htmlMsg)
+# Cached write connection for comment approvals, keyed by connection string
+# so a changed database.json naturally results in a fresh connection
+_write_connections = {}
+
+
+def get_write_connection(conn_string):
+    conn = _write_connections.get(conn_string)
+    if conn is None or conn.closed != 0:
+        conn = ps.connect(conn_string)
+        _write_connections[conn_string] = conn
+    return conn
+
+
+#
+# Cache of already verified Slack JWT payloads keyed by a hash of the
+# token, so a bearer reused across several calls skips the RSA signature
+# check. An entry never outlives the token's own exp claim, and is capped
+# at _TOKEN_CACHE_TTL seconds either way; only successful verifications
+# are cached
+#
+_verified_tokens = {}
+_verified_tokens_lock = threading.Lock()
+_TOKEN_CACHE_TTL = 300
+
+
+#
+# The public keys never change while the process runs, so each key file
+# is read from disk once instead of on every verification
+#
+@lru_cache(maxsize=4)
+def _load_public_key(key_filename):
+    with open(key_filename, "rb") as fptr:
+        return fptr.read()
+
+
+#
+# Shared by the Slack approve/deny endpoints: verify the JSON Web Token for
+# the given task against its public key file
+#    Returns None when the token is valid, otherwise an HTML error message
+#
+def verify_slack_token(authorization_token, key_filename, desired_task):
+    desired_app = "slackbot_comments_move"
     #
-    # Decode the token and check for validity
+    # Check whether this exact token was already verified recently
     #
-    desired_app = "slackbot_comments_move"
-    desired_task = "approve"
-    try:
-        decoded = jwt.decode(authorization_token, key, algorithms=["RS256"])
-        logging.info("Valid JSON Web Token")
-    except Exception as e:
-        logging.error("Invalid JSON Web Token")
-        htmlMsg = rds.generateHTMLErrorMessage("Invalid JSON Web Token: " + str(e))
-        return HTMLResponse(htmlMsg)
+    token_hash = hashlib.sha256(authorization_token.encode("utf-8")).hexdigest()
+    cache_key = (key_filename, token_hash)
+    decoded = None
+    with _verified_tokens_lock:
+        entry = _verified_tokens.get(cache_key)
+        if entry is not None:
+            if time.monotonic() < entry[0]:
+                decoded = entry[1]
+            else:
+                del _verified_tokens[cache_key]
+    if decoded is None:
+        #
+        # Peek at the unverified header first: a malformed token, or one
+        # not signed with RS256, is turned away before the key file is
+        # read or any RSA work is done
+        #
+        try:
+            header = jwt.get_unverified_header(authorization_token)
+        except Exception as e:
+            logger.error("Invalid JSON Web Token")
+            return rds.generateHTMLErrorMessage("Invalid JSON Web Token: " + str(e))
+        if header.get("alg") != "RS256":
+            logger.error("Invalid algorithm in JSON Web Token header")
+            return rds.generateHTMLErrorMessage(
+                "Invalid JSON Web Token: unexpected algorithm"
+            )
+        #
+        # Read in the public key ( cached after the first use )
+        #
+        try:
+            key = _load_public_key(key_filename)
+        except Exception as e:
+            logger.error("Bad information about public key filename")
+            return rds.generateHTMLErrorMessage(
+                "Bad information about public key filename: " + str(e)
+            )
+        #
+        # Decode the token and check for validity
+        #
+        try:
+            decoded = jwt.decode(authorization_token, key, algorithms=["RS256"])
+            logger.info("Valid JSON Web Token")
+        except Exception as e:
+            logger.error("Invalid JSON Web Token")
+            return rds.generateHTMLErrorMessage("Invalid JSON Web Token: " + str(e))
+        ttl = _TOKEN_CACHE_TTL
+        if "exp" in decoded:
+            ttl = min(ttl, decoded["exp"] - time.time())
+        if ttl > 0:
+            with _verified_tokens_lock:
+                _verified_tokens[cache_key] = (time.monotonic() + ttl, decoded)
     #
     # Check to see if the JWT payload is valid
     #
     if decoded["app"] != desired_app:
-        logging.error("Invalid app in JSON Web Token payload")
-        htmlMsg = rds.generateHTMLErrorMessage("Invalid app in JSON Web Token payload")
-        return HTMLResponse(htmlMsg)
-    else:
-        logging.info("JWT app = " + decoded["app"])
+        logger.error("Invalid app in JSON Web Token payload")
+        return rds.generateHTMLErrorMessage("Invalid app in JSON Web Token payload")
+    logger.info("JWT app = " + decoded["app"])
     if decoded["task"] != desired_task:
-        logging.error("Invalid task in JSON Web Token payload")
-        htmlMsg = rds.generateHTMLErrorMessage("Invalid task in JSON Web Token payload")
-        return HTMLResponse(htmlMsg)
-    else:
-        logging.info("JWT task = " + decoded["app"])
-    #
-    # decode keys
-    #
+        logger.error("Invalid task in JSON Web Token payload")
+        return rds.generateHTMLErrorMessage("Invalid task in JSON Web Token payload")
+    logger.info("JWT task = " + decoded["task"])
+    return None
+
+
+#
+# Shared by the Slack approve/deny endpoints: decrypt the AWS credentials
+# with the Fernet key
+#    Returns the ( access, secret ) pair
+#    Cached: the encrypted keys are fixed for the life of the process, so
+#    the env/file reads and Fernet decryption happen once instead of on
+#    every Slack call
+#
+@lru_cache(maxsize=1)
+def get_s3_credentials():
     key = load_key()
     # initialize the Fernet class
     f = Fernet(key)
@@ -543,19 +683,41 @@ async def slack_approve_comment(
 
     access = f.decrypt(encrypt1.encode("utf-8")).decode("utf-8")
     secret = f.decrypt(encrypt2.encode("utf-8")).decode("utf-8")
+    return access, secret
+
+
+@router.post("/slack/approve/{comment_id}", tags=["Internal Slack"])
+def slack_approve_comment(
+    comment_id: str, authorization_token: str, reviewer: Optional[str] = "none"
+):
+    logger.info("/slack/approve called")
+    #
+    # Information for the task
+    #
+    key_filename = "slackbot_comments_move_approve_key.pub"
+    #
+    # Verify the token for this task
+    #
+    errMsg = verify_slack_token(authorization_token, key_filename, "approve")
+    if errMsg is not None:
+        return HTMLResponse(errMsg)
+    #
+    # decode keys
+    #
+    access, secret = get_s3_credentials()
     #
     #  Access AWS Credentials and establish session as a client and resource
     #
     s3_client = s3f.credentials_client(access, secret)
     if s3_client == -1:
-        logging.error("Cannot connect to S3 as client")
+        logger.error("Cannot connect to S3 as client")
         htmlMsg = rds.generateHTMLErrorMessage(
             "Cannot connect to S3 as client: " + access + " and " + secret
         )
         return HTMLResponse(htmlMsg)
     s3_resource = s3f.credentials_resource(access, secret)
     if s3_resource == -1:
-        logging.error("Cannot connect to S3 as resource")
+        logger.error("Cannot connect to S3 as resource")
         htmlMsg = rds.generateHTMLErrorMessage(
             "Cannot connect to S3 as resource: " + access + " and " + secret
         )
@@ -570,24 +732,25 @@ async def slack_approve_comment(
     srcFolder = "underreview/"
     key0 = srcFolder + comment_id
     json_object = s3_client.get_object(Bucket=bucket, Key=key0)
-    file_reader = json_object["Body"].read().decode("utf-8")
-    file_reader = json.loads(file_reader)
+    # json.loads accepts the raw bytes directly, no utf-8 decode copy needed
+    file_reader = json.loads(json_object["Body"].read())
 
     # htmlstring = htmlstring+" <li>stage 2a - json "+key0+" retrieved and loaded</li>"
 
     created = str(file_reader["created"])[0:19]
-    approved = str(datetime.datetime.now())[0:19]
-    dashboard = str(file_reader["dashboard"])
-    table = str(file_reader["table"])
-    subject = str(file_reader["subject"])
-    message = str(file_reader["message"])
+    approved = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # these fields are already strings in the comment JSON
+    dashboard = file_reader["dashboard"]
+    table = file_reader["table"]
+    subject = file_reader["subject"]
+    message = file_reader["message"]
     isPublic = str(file_reader["isPublic"]).upper()
     if isPublic == "FALSE":
         name = "NULL"
         email = "NULL"
     else:
-        name = str(file_reader["name"])
-        email = str(file_reader["email"])
+        name = file_reader["name"]
+        email = file_reader["email"]
     if len(reviewer) > 0:
         dbRow = (
             "('"
@@ -647,9 +810,7 @@ async def slack_approve_comment(
 
     # htmlstring = htmlstring+" <li>stage 3a - json "+key1+" started...</li>"
 
-    json_object1 = s3_client.get_object(Bucket=bucket, Key=key1)
-    file_reader1 = json_object1["Body"].read().decode("utf-8")
-    file_reader1 = json.loads(file_reader1)
+    file_reader1 = json.loads(s3f.s3GetCached(s3_client, bucket, key1))
     db_host = str(file_reader1["DBHOST"])
     db_name = str(file_reader1["DBNAME"])
     db_user = str(file_reader1["DBUSER"])
@@ -670,15 +831,24 @@ async def slack_approve_comment(
         + " password="
         + db_pass
     )
-    conn_write = ps.connect(conn_string)
+    conn_write = get_write_connection(conn_string)
     cur_write = conn_write.cursor()
     insert_string = "INSERT into gbads_comments VALUES " + dbRow + ";"
-    cur_write.execute(insert_string)
     #
-    # Commit data insertion and close database connection
+    # Commit the data insertion ( the connection stays open for the next
+    # approval ); on any failure roll back so the cached connection is not
+    # left in an aborted transaction that would poison later approvals
     #
-    conn_write.commit()
-    conn_write.close()
+    try:
+        cur_write.execute(insert_string)
+        conn_write.commit()
+    except Exception as e:
+        logger.error("Error inserting comment into database")
+        conn_write.rollback()
+        htmlMsg = rds.generateHTMLErrorMessage(
+            "Error inserting comment into database: " + str(e)
+        )
+        return HTMLResponse(htmlMsg)
 
     # htmlstring = htmlstring+" <li>stage 3b - database table insert completed</li>"
 
@@ -690,104 +860,52 @@ async def slack_approve_comment(
     destFolder = "approved/"
     sourceObj = srcFolder + comment_id
     destObj = destFolder + comment_id
-    ret = s3f.s3Copy(s3_client, bucket, sourceObj, destObj)
-    #
-    # Next: 2) delete the original file
-    #
+    ret = s3f.s3Move(s3_client, bucket, sourceObj, destObj)
     if ret == 0:
-        ret = s3f.s3Delete(s3_client, bucket, sourceObj)
-        if ret == 0:
-            logging.info("S3 Approve successful")
-            htmlstring = (
-                "<html><body><H3>GBADs S3 Slack Approve Comment</h3></body></html>"
-            )
-            # htmlstring = "<html><body><H2>Slackbot</h2><ul><li>stage 1 good</li>"
-            return HTMLResponse(htmlstring)
-        else:
-            logging.error("S3 Delete not successful")
-            htmlMsg = rds.generateHTMLErrorMessage("S3 Delete not successful")
-            return HTMLResponse(htmlMsg)
-    else:
-        logging.error("S3 Copy not successful")
+        logger.info("S3 Approve successful")
+        htmlstring = (
+            "<html><body><H3>GBADs S3 Slack Approve Comment</h3></body></html>"
+        )
+        # htmlstring = "<html><body><H2>Slackbot</h2><ul><li>stage 1 good</li>"
+        return HTMLResponse(htmlstring)
+    elif ret == 1:
+        logger.error("S3 Copy not successful")
         htmlMsg = rds.generateHTMLErrorMessage("S3 Copy not successful")
         return HTMLResponse(htmlMsg)
+    else:
+        logger.error("S3 Delete not successful")
+        htmlMsg = rds.generateHTMLErrorMessage("S3 Delete not successful")
+        return HTMLResponse(htmlMsg)
 
 
 @router.post("/slack/deny/{comment_id}", tags=["Internal Slack"])
 def slack_deny_comment(comment_id: str, authorization_token: str):
-    logging.info("/slack/deny called")
+    logger.info("/slack/deny called")
     #
     # Information for the task
     #
     key_filename = "slackbot_comments_move_deny_key.pub"
     #
-    # Read in the public key
-    #
-    try:
-        fptr = open(key_filename, "rb")
-        key = fptr.read()
-        fptr.close()
-    except Exception as e:
-        logging.error("Bad information about public key filename")
-        htmlMsg = rds.generateHTMLErrorMessage(
-            "Bad information about public key filename: " + str(e)
-        )
-        return HTMLResponse(htmlMsg)
-    #
-    # Decode the token and check for validity
-    #
-    desired_app = "slackbot_comments_move"
-    desired_task = "deny"
-    try:
-        decoded = jwt.decode(authorization_token, key, algorithms=["RS256"])
-        logging.info("Valid JSON Web Token")
-    except Exception as e:
-        logging.error("Invalid JSON Web Token")
-        htmlMsg = rds.generateHTMLErrorMessage("Invalid JSON Web Token: " + str(e))
-        return HTMLResponse(htmlMsg)
+    # Verify the token for this task
     #
-    # Check to see if the JWT payload is valid
-    #
-    if decoded["app"] != desired_app:
-        logging.error("Invalid app in JSON Web Token payload")
-        htmlMsg = rds.generateHTMLErrorMessage("Invalid app in JSON Web Token payload")
-        return HTMLResponse(htmlMsg)
-    else:
-        logging.info("JWT app = " + decoded["app"])
-    if decoded["task"] != desired_task:
-        logging.error("Invalid task in JSON Web Token payload")
-        htmlMsg = rds.generateHTMLErrorMessage("Invalid task in JSON Web Token payload")
-        return HTMLResponse(htmlMsg)
-    else:
-        logging.info("JWT task = " + decoded["task"])
+    errMsg = verify_slack_token(authorization_token, key_filename, "deny")
+    if errMsg is not None:
+        return HTMLResponse(errMsg)
     #
     # decode keys
     #
-    key = load_key()
-    # initialize the Fernet class
-    f = Fernet(key)
-    # read the encrypted keys
-    encrypt1 = os.environ.get("MAJOR_INFO1", "")
-    encrypt2 = os.environ.get("MAJOR_INFO2", "")
-    if not encrypt1:
-        with open("info.conf", "r") as info_file:
-            encrypt1 = info_file.readline().strip()
-            encrypt2 = info_file.readline().strip()
-
-    access = f.decrypt(encrypt1.encode("utf-8")).decode("utf-8")
-    secret = f.decrypt(encrypt2.encode("utf-8")).decode("utf-8")
-
+    access, secret = get_s3_credentials()
     #
     #  Access AWS Credentials and establish session as a client and resource
     #
     s3_client = s3f.credentials_client(access, secret)
     if s3_client == -1:
-        logging.error("Cannot connect to S3 as client")
+        logger.error("Cannot connect to S3 as client")
         htmlMsg = rds.generateHTMLErrorMessage("Cannot connect to S3 as client")
         return HTMLResponse(htmlMsg)
     s3_resource = s3f.credentials_resource(access, secret)
     if s3_resource == -1:
-        logging.error("Cannot connect to S3 as resource")
+        logger.error("Cannot connect to S3 as resource")
         htmlMsg = rds.generateHTMLErrorMessage(
             "Cannot connect to S3 as resource: " + access + " and " + secret
         )
@@ -800,26 +918,19 @@ def slack_deny_comment(comment_id: str, authorization_token: str):
     destFolder = "notapproved/"
     sourceObj = srcFolder + comment_id
     destObj = destFolder + comment_id
-    ret = s3f.s3Copy(s3_client, bucket, sourceObj, destObj)
-    #
-    # Next: 2) delete the original file
-    #
+    ret = s3f.s3Move(s3_client, bucket, sourceObj, destObj)
     if ret == 0:
-        ret = s3f.s3Delete(s3_client, bucket, sourceObj)
-        if ret == 0:
-            logging.info("S3 Deny successful")
-            htmlstring = (
-                "<html><body><H3>GBADs S3 Slack Deny Comment</h3></body></html>"
-            )
-            return HTMLResponse(htmlstring)
-        else:
-            logging.error("S3 Delete not successful")
-            htmlMsg = rds.generateHTMLErrorMessage("S3 Delete not successful")
-            return HTMLResponse(htmlMsg)
-    else:
-        logging.error("S3 Copy not successful")
+        logger.info("S3 Deny successful")
+        htmlstring = "<html><body><H3>GBADs S3 Slack Deny Comment</h3></body></html>"
+        return HTMLResponse(htmlstring)
+    elif ret == 1:
+        logger.error("S3 Copy not successful")
         htmlMsg = rds.generateHTMLErrorMessage("S3 Copy not successful")
         return HTMLResponse(htmlMsg)
+    else:
+        logger.error("S3 Delete not successful")
+        htmlMsg = rds.generateHTMLErrorMessage("S3 Delete not successful")
+        return HTMLResponse(htmlMsg)
 
 
 # This router allows a custom path to be used for the API
@@ -3,6 +3,37 @@
 #  S3 Functions
 #
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+#
+#  Shared client configuration and per-credential caches
+#  Building a boto3 client loads service models and opens fresh HTTPS
+#  connections, so clients/resources are created once per credential pair
+#  and reused; keepalive holds the TLS connections open between calls and
+#  adaptive retries back off correctly when S3 throttles
+#
+client_config = Config(
+    max_pool_connections=50,
+    tcp_keepalive=True,
+    retries={"max_attempts": 10, "mode": "adaptive"},
+)
+_clients = {}
+_resources = {}
+
+#
+#  Transfer tuning shared by uploads and downloads: files above the
+#  multipart threshold are split into parts and moved by a small thread
+#  pool instead of one sequential stream, which keeps large GBADs data
+#  files from being bottlenecked on a single connection
+#
+MB = 1024 * 1024
+transfer_config = TransferConfig(
+    multipart_threshold=8 * MB,
+    multipart_chunksize=16 * MB,
+    max_concurrency=16,
+    use_threads=True,
+)
 
 
 #
@@ -11,13 +42,16 @@ import boto3
 def credentials_client(access, secret):
     aws_access_key_id = access
     aws_secret_access_key = secret
+    if (access, secret) in _clients:
+        return _clients[(access, secret)]
     try:
         session = boto3.Session(
             aws_access_key_id=aws_access_key_id,
             aws_secret_access_key=aws_secret_access_key,
             region_name="ca-central-1",
         )
-        s3_client = session.client("s3")
+        s3_client = session.client("s3", config=client_config)
+        _clients[(access, secret)] = s3_client
         return s3_client
     except Exception as e:
         # Cannot connect to S3 as client
@@ -29,13 +63,16 @@ def credentials_client(access, secret):
 def credentials_resource(access, secret):
     aws_access_key_id = access
     aws_secret_access_key = secret
+    if (access, secret) in _resources:
+        return _resources[(access, secret)]
     try:
         session = boto3.Session(
             aws_access_key_id=aws_access_key_id,
             aws_secret_access_key=aws_secret_access_key,
             region_name="ca-central-1",
         )
-        s3_resource = session.resource("s3")
+        s3_resource = session.resource("s3", config=client_config)
+        _resources[(access, secret)] = s3_resource
         return s3_resource
     except Exception as e:
         # Cannot connect to S3 as client
@@ -56,6 +93,20 @@ def s3Copy(s3_client, bucket, sourceObj, destObj):
     return ret
 
 
+# Move an object within a bucket: server-side copy followed by a delete of
+# the original. Returns 0 on success, 1 if the copy failed ( nothing was
+# changed ) and 2 if the delete failed ( the object now exists in both
+# places and the delete can be retried safely )
+def s3Move(s3_client, bucket, sourceObj, destObj):
+    ret = s3Copy(s3_client, bucket, sourceObj, destObj)
+    if ret != 0:
+        return 1
+    ret = s3Delete(s3_client, bucket, sourceObj)
+    if ret != 0:
+        return 2
+    return 0
+
+
 # Delete an object given bucket and path to object
 def s3Delete(s3_client, bucket, objectPath):
     # response = s3_client.delete_object(Bucket=bucket, Key=objectPath)
@@ -63,10 +114,30 @@ def s3Delete(s3_client, bucket, objectPath):
     return ret
 
 
+# Fetch an object's bytes with an ETag-validated in-memory cache
+# A cheap HeadObject replaces the full GetObject when the object has not
+# changed since the last fetch; intended for small objects that are read
+# repeatedly ( e.g. configuration files )
+_object_cache = {}
+
+
+def s3GetCached(s3_client, bucket, key):
+    head = s3_client.head_object(Bucket=bucket, Key=key)
+    etag = head["ETag"]
+    cached = _object_cache.get((bucket, key))
+    if cached is not None and cached[0] == etag:
+        return cached[1]
+    body = s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+    _object_cache[(bucket, key)] = (etag, body)
+    return body
+
+
 # Upload an object (file) given bucket and source and destination paths
 def s3Upload(s3_resource, bucket, source_path, destination_path):
     try:
-        s3_resource.Bucket(bucket).upload_file(source_path, destination_path)
+        s3_resource.Bucket(bucket).upload_file(
+            source_path, destination_path, Config=transfer_config
+        )
         ret = 0
         return ret
     except Exception as e:
@@ -78,7 +149,9 @@ def s3Upload(s3_resource, bucket, source_path, destination_path):
 # Download an object (file) given bucket and source and destination paths
 def s3Download(s3_resource, bucket, source, destination_path):
     try:
-        s3_resource.Bucket(bucket).download_file(source, destination_path)
+        s3_resource.Bucket(bucket).download_file(
+            source, destination_path, Config=transfer_config
+        )
         ret = 0
         return ret
     except Exception as e:
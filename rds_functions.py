@@ -10,9 +10,66 @@
 # Libraries
 #
 # import psycopg2 as ps
+import os
+import time
 from typing import Optional
 
 
+#
+# In-process TTL cache for table metadata lookups
+#    The list of tables and their fields change rarely, so repeated API calls
+#    can be answered from memory instead of a database round trip.
+#    Entries are stored as (expiry time, value) keyed by lookup name.
+#    The TTL can be tuned per deployment with RDS_META_CACHE_TTL ( seconds );
+#    schema changes show up after at most one TTL, or immediately after a
+#    call to invalidateCache().
+#
+_metadataCache = {}
+_METADATA_CACHE_TTL = int(os.environ.get("RDS_META_CACHE_TTL", "300"))
+
+
+def _cacheGet(key):
+    entry = _metadataCache.get(key)
+    if entry is None:
+        return None
+    expiry, value = entry
+    if time.monotonic() >= expiry:
+        # pop() rather than del: two threadpool workers can expire the
+        # same key at once, and the second delete must not raise
+        _metadataCache.pop(key, None)
+        return None
+    return value
+
+
+def _cachePut(key, value):
+    _metadataCache[key] = (time.monotonic() + _METADATA_CACHE_TTL, value)
+    return value
+
+
+#
+# invalidateCache clears the metadata cache so the next lookup hits the
+#    database again ( used after tables are added or changed )
+#    Parameter(s): none
+#    Returns: nothing
+#
+def invalidateCache():
+    _metadataCache.clear()
+
+
+#
+# Introspection query strings
+#    Built once at import instead of being re-assembled on every call;
+#    the same table listing is shared by displayTables and checkTable
+#
+TABLES_SQL = "SELECT table_name FROM information_schema.tables WHERE table_schema='public' ORDER BY table_name ;"
+TABLE_INFO_SQL = (
+    "SELECT column_name,data_type FROM information_schema.columns WHERE table_name='%s';"
+)
+TABLE_FIELDS_SQL = (
+    "SELECT column_name FROM information_schema.columns WHERE table_name=%s;"
+)
+
+
 #
 #  Functions
 #
@@ -24,11 +81,12 @@ from typing import Optional
 #    Returns: table names
 #
 def displayTables(cur):
-    cur.execute(
-        "SELECT table_schema,table_name FROM information_schema.tables WHERE table_schema='public' ORDER BY table_schema,table_name ;"
-    )
+    tables = _cacheGet("tables")
+    if tables is not None:
+        return tables
+    cur.execute(TABLES_SQL)
     tables = cur.fetchall()
-    return tables
+    return _cachePut("tables", tables)
 
 
 #
@@ -37,12 +95,12 @@ def displayTables(cur):
 #    Returns: column names and datatypes
 #
 def displayTabInfo(cur, table_name):
-    cur.execute(
-        "SELECT column_name,data_type FROM information_schema.columns WHERE table_name='%s';"
-        % (table_name)
-    )
+    response = _cacheGet(("tabinfo", table_name))
+    if response is not None:
+        return response
+    cur.execute(TABLE_INFO_SQL % (table_name))
     response = cur.fetchall()
-    return response
+    return _cachePut(("tabinfo", table_name), response)
 
 
 #
@@ -51,9 +109,7 @@ def displayTabInfo(cur, table_name):
 #    Returns: 1 if table is in the database and 0 if it is not
 #
 def checkTable(cur, table_name):
-    cur.execute(
-        "SELECT table_schema,table_name FROM information_schema.tables WHERE table_schema='public' ORDER BY table_schema,table_name ;"
-    )
+    cur.execute(TABLES_SQL)
     tabs = cur.fetchall()
     if any(table_name in i for i in tabs):
         ret_flag = 1
@@ -68,12 +124,11 @@ def checkTable(cur, table_name):
 #    Returns: 1 if every field checks out and 0 otherwise
 #
 def checkDataFields(cur, table_name, fieldstring):
-    cur.execute(
-        "SELECT column_name FROM information_schema.columns WHERE table_name=%s;"
-        % (table_name)
-    )
-    # cur.execute(f"""SELECT column_name FROM information_schema.columns WHERE table_name='{table_name}' ;""")
-    fields_list = cur.fetchall()
+    fields_list = _cacheGet(("fields", table_name))
+    if fields_list is None:
+        cur.execute(TABLE_FIELDS_SQL % (table_name))
+        # cur.execute(f"""SELECT column_name FROM information_schema.columns WHERE table_name='{table_name}' ;""")
+        fields_list = _cachePut(("fields", table_name), cur.fetchall())
     ret = 0
     flist = fieldstring.split(",")
     num = len(flist)
@@ -100,55 +155,114 @@ def setJoin(table_name1, table_name2, jfield_1, jfield_2):
 
 
 #
-# The query method. Queries the database and returns the answer
-#   Parameter(s): Cursor pointer to database generated by psycopg2, table_name name of table, selectstring: Query string, joinstring, order: order by value
-#   Returns: The answer to the query
+# _runQuery builds and executes a SELECT on the given cursor
+#   Parameter(s): Cursor pointer to database generated by psycopg2, table_name name of table, selectstring: Query string, joinstring, order: order by value,
+#      params: optional values for %s placeholders in the where string
+#      ( letting psycopg2 quote them and the server reuse the plan )
+#   Returns: nothing ( results are fetched from the cursor by the caller )
 #
-def query(
-    cursor, table_name, selectstring, wherestring, joinstring, order: Optional[str] = ""
+def _runQuery(
+    cursor,
+    table_name,
+    selectstring,
+    wherestring,
+    joinstring,
+    order: Optional[str] = "",
+    params=None,
 ):
     if wherestring == "":
         if joinstring == "":
             if order != "":
-                cursor.execute(
-                    "SELECT %s FROM %s ORDER BY %s" % (selectstring, table_name, order)
+                sql = "SELECT %s FROM %s ORDER BY %s" % (
+                    selectstring,
+                    table_name,
+                    order,
                 )
             else:
-                cursor.execute("SELECT %s FROM %s" % (selectstring, table_name))
+                sql = "SELECT %s FROM %s" % (selectstring, table_name)
         else:
             if order != "":
-                cursor.execute(
-                    "SELECT %s %s ORDER BY %s" % (selectstring, joinstring, order)
-                )
+                sql = "SELECT %s %s ORDER BY %s" % (selectstring, joinstring, order)
             else:
-                cursor.execute("SELECT %s %s " % (selectstring, joinstring))
+                sql = "SELECT %s %s " % (selectstring, joinstring)
     else:
         if joinstring == "":
             if order != "":
-                cursor.execute(
-                    "SELECT %s FROM %s WHERE %s ORDER BY %s"
-                    % (selectstring, table_name, wherestring, order)
+                sql = "SELECT {} FROM {} WHERE {} ORDER BY {}".format(
+                    selectstring, table_name, wherestring, order
                 )
             else:
-                cursor.execute(
-                    "SELECT %s FROM %s WHERE %s"
-                    % (selectstring, table_name, wherestring)
+                sql = "SELECT {} FROM {} WHERE {}".format(
+                    selectstring, table_name, wherestring
                 )
         else:
             if order != "":
-                cursor.execute(
-                    "SELECT %s %s WHERE %s ORDER BY %s"
-                    % (selectstring, joinstring, wherestring, order)
+                sql = "SELECT {} {} WHERE {} ORDER BY {}".format(
+                    selectstring, joinstring, wherestring, order
                 )
             else:
-                cursor.execute(
-                    "SELECT %s %s WHERE %s" % (selectstring, joinstring, wherestring)
+                sql = "SELECT {} {} WHERE {}".format(
+                    selectstring, joinstring, wherestring
                 )
+    if params:
+        cursor.execute(sql, params)
+    else:
+        cursor.execute(sql)
 
+
+#
+# The query method. Queries the database and returns the answer
+#   Parameter(s): Cursor pointer to database generated by psycopg2, table_name name of table, selectstring: Query string, joinstring, order: order by value
+#   Returns: The answer to the query
+#
+def query(
+    cursor,
+    table_name,
+    selectstring,
+    wherestring,
+    joinstring,
+    order: Optional[str] = "",
+    params=None,
+):
+    _runQuery(cursor, table_name, selectstring, wherestring, joinstring, order, params)
     answer = cursor.fetchall()
     return answer
 
 
+#
+# queryStream runs the same query as query() but returns an iterator that
+#    walks the cursor in batches instead of building a second full-size
+#    list with fetchall ( used for large exports ). Note that psycopg2's
+#    default client-side cursor still buffers the raw result set when the
+#    query executes, so this saves the extra Python list of tuples, not
+#    the driver's own buffer; a server-side ( named ) cursor would be
+#    needed to bound that as well.
+#   Parameter(s): same as query(), plus batch_size rows per fetch
+#   Returns: iterator over the rows of the answer
+#
+def queryStream(
+    cursor,
+    table_name,
+    selectstring,
+    wherestring,
+    joinstring,
+    order: Optional[str] = "",
+    batch_size=1000,
+    params=None,
+):
+    _runQuery(cursor, table_name, selectstring, wherestring, joinstring, order, params)
+    return _fetchBatches(cursor, batch_size)
+
+
+def _fetchBatches(cursor, batch_size):
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
 #
 # The countQuery method. Queries the database to retrieve the number of records
 #   Parameter(s): Cursor pointer to database generated by psycopg2, table_name name of table, selectstring: Query string, joinstring, order: order by value
@@ -237,6 +351,22 @@ def setCountQuery(table_name, selectstring, wherestring, joinstring):
     return querystring
 
 
+#
+# insertMany inserts a batch of rows into a table with a single executemany
+#    call instead of one round trip per row ( intended for bulk imports;
+#    the caller owns the commit )
+#    Parameter(s): pointer to database generated by psycopg2, table name,
+#       list of row tuples ( all the same width )
+#    Returns: number of rows submitted
+#
+def insertMany(cur, table_name, rows):
+    if not rows:
+        return 0
+    placeholders = ",".join(["%s"] * len(rows[0]))
+    cur.executemany("INSERT INTO " + table_name + " VALUES (" + placeholders + ")", rows)
+    return len(rows)
+
+
 #
 # execute runs the query against the database
 #    Parameter(s): pointer to database generated by psycopg2, query string
@@ -249,10 +379,14 @@ def execute(cur, querystring):
 
 
 def generateFieldNames(cur, tablename):
-    cur.execute("SELECT * FROM %s" % (tablename))
-    # rows = cur.fetchone()
+    colunmnames = _cacheGet(("fieldnames", tablename))
+    if colunmnames is not None:
+        return colunmnames
+    # LIMIT 0 still populates cursor.description with the column names but
+    # keeps the server from scanning and returning the whole table
+    cur.execute("SELECT * FROM %s LIMIT 0" % (tablename))
     colunmnames = [desc[0] for desc in cur.description]
-    return colunmnames
+    return _cachePut(("fieldnames", tablename), colunmnames)
 
 
 # Error message for bad query
@@ -18,15 +18,153 @@
 #
 # Libraries
 #
+import atexit
+import os
+import threading
+import time
+
 import psycopg2 as ps
 
+#
+# Connection tunables ( read from the environment so deployments can
+#    adjust them without a code change ):
+#       RDS_CONNECT_TIMEOUT   - seconds to wait for a connection before
+#                               failing fast ( default 10 )
+#       RDS_STATEMENT_TIMEOUT - milliseconds a single query may run before
+#                               the server cancels it ( default 0 = no limit )
+#       RDS_POOL_SIZE         - connections kept per database ( default 4 );
+#                               bounds this process's RDS sessions while
+#                               setting how many queries can run in parallel
+#
+_CONNECT_TIMEOUT = int(os.environ.get("RDS_CONNECT_TIMEOUT", "10"))
+_STATEMENT_TIMEOUT = int(os.environ.get("RDS_STATEMENT_TIMEOUT", "0"))
+
+
+#
+# Pool of open connections keyed by connection string
+#    Every endpoint used to call ps.connect() on each request, paying the
+#    TCP + authentication handshake every time ( and leaking the old
+#    connection ). Each connection string now has a small fixed pool of
+#    persistent connections handed out round-robin. psycopg2 connections
+#    are thread-safe ( it serializes commands per connection ), so callers
+#    never need to check them back in; the pool simply spreads concurrent
+#    queries across _POOL_SIZE sockets instead of serializing on one.
+#    A closed or broken connection is replaced on the next call.
+#
+#    The lock only guards the slot bookkeeping; connecting and pinging are
+#    network I/O and happen outside it, so one slow handshake cannot stall
+#    every other request in the process. A connection is only pinged when
+#    it has sat idle for more than _PING_IDLE_SECONDS ( a recently used
+#    one is assumed healthy ), so busy traffic pays no extra round trip.
+#
+_POOL_SIZE = int(os.environ.get("RDS_POOL_SIZE", "4"))
+_PING_IDLE_SECONDS = 30
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+#
+# Close any pooled connections at interpreter exit. Registered once at
+#    import so cleanup cannot be registered ( and run ) more than once;
+#    the closed check makes the handler safe if a connection already
+#    dropped on its own.
+#
+def _close_connections():
+    for pool in _pools.values():
+        for slot in pool["slots"]:
+            conn = slot["conn"]
+            if conn is not None and conn.closed == 0:
+                conn.close()
+    _pools.clear()
+
+
+atexit.register(_close_connections)
+
+
+#
+def _new_connection(conn_string):
+    options = ""
+    if _STATEMENT_TIMEOUT > 0:
+        options = "-c statement_timeout=%d" % _STATEMENT_TIMEOUT
+    conn = ps.connect(
+        conn_string,
+        connect_timeout=_CONNECT_TIMEOUT,
+        options=options,
+        #
+        # Short TCP keepalives so a connection silently dropped by a NAT or
+        # proxy idle timeout is detected in seconds instead of stalling the
+        # next query for the full TCP timeout
+        #
+        keepalives=1,
+        keepalives_idle=30,
+        keepalives_interval=10,
+        keepalives_count=3,
+    )
+    #
+    # These connections only ever read, so declare that to the server and
+    # use autocommit: a reused connection no longer holds an open
+    # transaction ( idle-in-transaction ) between requests
+    #
+    conn.set_session(readonly=True, autocommit=True)
+    return conn
+
+
+#
+# _ping checks that a pooled connection still answers; a dead connection
+#    would otherwise only fail once a real query hits it
+#
+def _ping(conn):
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.fetchone()
+        return True
+    except Exception:
+        return False
+
+
+#
+def _connect(conn_string):
+    #
+    # Hand out the next pooled connection, growing the pool up to
+    # _POOL_SIZE slots on demand and replacing any connection that has
+    # closed or stopped responding. Only the round-robin slot pick runs
+    # under the lock; the connect/ping happens after it is released.
+    #
+    now = time.monotonic()
+    with _pools_lock:
+        pool = _pools.get(conn_string)
+        if pool is None:
+            pool = {"slots": [], "next": 0}
+            _pools[conn_string] = pool
+        slots = pool["slots"]
+        if len(slots) < _POOL_SIZE:
+            slot = {"conn": None, "last_used": now}
+            slots.append(slot)
+        else:
+            i = pool["next"] % len(slots)
+            pool["next"] = i + 1
+            slot = slots[i]
+    conn = slot["conn"]
+    idle = now - slot["last_used"]
+    if (
+        conn is None
+        or conn.closed != 0
+        or (idle > _PING_IDLE_SECONDS and not _ping(conn))
+    ):
+        conn = _new_connection(conn_string)
+        slot["conn"] = conn
+    slot["last_used"] = now
+    return conn
+
 
 #
 def connect_public():
     #
-    # Create connection and cursor
+    # Create ( or reuse ) connection
     #
-    conn = ps.connect(
+    conn = _connect(
         "host=gbadske-database-public-data.cp73fx22weet.ca-central-1.rds.amazonaws.com dbname=publicData_1 user=reader password=readonly"
     )
     #
@@ -45,7 +183,7 @@ def connect_private():
     #
     # Create connection and cursor
     #
-    conn = ps.connect(
+    conn = _connect(
         "host=gbadske-database-private-data.cp73fx22weet.ca-central-1.rds.amazonaws.com dbname=privateData_1 user=reader password=readonly"
     )
     #